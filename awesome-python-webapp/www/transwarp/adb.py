@@ -0,0 +1,130 @@
+# coding=utf-8
+"""
+基于 asyncpg 的异步数据库模块，接口与 db 模块保持一致：
+sql 同样使用 ? 作为占位符，查询结果同样是 Dict
+    await adb.create_pool('postgres', '1129', 'test')
+    u = await adb.select_one('select * from "user" where id=?', 100)
+asyncpg 自带二进制协议和预备语句缓存，单个进程即可同时执行大量查询
+"""
+
+import asyncio
+import logging
+
+import asyncpg
+
+from .dbutil import Dict, MultiColumsError, numbered
+
+
+logger = logging.getLogger(__name__)
+
+# 全局连接池
+pool = None
+
+# 保护连接池的创建，多个协程同时调用 create_pool 时只会创建一次
+_pool_lock = None
+
+
+async def create_pool(user, password, database, host='127.0.0.1', port=5432, **kw):
+    """
+    创建全局连接池，参数与 asyncpg.create_pool 一致：
+        min_size: 连接池最少保持的连接数，默认 5
+        max_size: 连接池最多允许的连接数，默认 20
+        max_queries: 单个连接执行多少次查询后重建，默认 50000
+        max_inactive_connection_lifetime: 空闲连接的最长存活秒数，默认 300
+    连接池已经创建时直接返回已有的连接池
+    """
+    global pool, _pool_lock
+    if pool is not None:
+        return pool
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if pool is not None:
+            return pool
+        kw.setdefault('min_size', 5)
+        kw.setdefault('max_size', 20)
+        kw.setdefault('max_queries', 50000)
+        kw.setdefault('max_inactive_connection_lifetime', 300.0)
+        pool = await asyncpg.create_pool(user=user, password=password,
+                                         database=database, host=host, port=port, **kw)
+        logger.info('Init asyncpg pool <%#x> ok.', id(pool))
+        return pool
+
+
+async def close_pool():
+    """
+    关闭全局连接池
+    """
+    global pool
+    if pool is not None:
+        _pool = pool
+        pool = None
+        await _pool.close()
+
+
+async def select(sql, *args):
+    """
+    执行sql 以列表形式返回结果
+    """
+    logger.info('SQL: %s, ARGS: %s', sql, args)
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(numbered(sql), *args)
+    return [Dict(r.keys(), r.values()) for r in rows]
+
+
+async def select_one(sql, *args):
+    """
+    执行sql 仅返回一个结果，如果没有结果 返回None
+    """
+    logger.info('SQL: %s, ARGS: %s', sql, args)
+    async with pool.acquire() as conn:
+        r = await conn.fetchrow(numbered(sql), *args)
+    if r is None:
+        return None
+    return Dict(r.keys(), r.values())
+
+
+async def select_int(sql, *args):
+    """
+    执行一个sql 返回一个数值，如果返回多个数值将触发异常
+    如果没有结果 返回None
+    """
+    logger.info('SQL: %s, ARGS: %s', sql, args)
+    async with pool.acquire() as conn:
+        r = await conn.fetchrow(numbered(sql), *args)
+    if r is None:
+        return None
+    if len(r) != 1:
+        raise MultiColumsError('Expect only one colum.')
+    return r[0]
+
+
+async def update(sql, *args):
+    """
+    执行update语句， 返回update的行数
+    """
+    logger.info('SQL: %s, ARGS: %s', sql, args)
+    async with pool.acquire() as conn:
+        status = await conn.execute(numbered(sql), *args)
+    # status 形如 'UPDATE 3' 或 'INSERT 0 1'，最后一项为影响的行数
+    try:
+        return int(status.split()[-1])
+    except ValueError:
+        return 0
+
+
+def _quote_ident(name):
+    """
+    按 postgres 标识符规则加双引号，名字中的双引号写两遍
+    """
+    return '"%s"' % name.replace('"', '""')
+
+
+async def insert(table, **kw):
+    """
+    执行insert语句，返回insert的行数
+    """
+    cols, args = zip(*kw.items())
+    sql = 'insert into %s (%s) values (%s)' % (_quote_ident(table), ','.join(
+        [_quote_ident(col) for col in cols]), ','.join(["?" for i in range(len(cols))]))
+    return await update(sql, *args)
@@ -1,24 +1,129 @@
 # coding=utf-8
 
+import os
+import json
 import time
 import uuid
+import decimal
+import binascii
+import datetime
+import itertools
+import weakref
 import threading
 import functools
 import logging
+import numbers
+import collections
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR
+from psycopg2.extras import execute_values
+from psycopg2.sql import SQL, Identifier
 
+try:
+    from .dbutil import DBError, MultiColumsError, Dict, numbered
+except (ImportError, ValueError):
+    # 作为脚本直接运行（python db.py）时不在包中
+    from dbutil import DBError, MultiColumsError, Dict, numbered
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+try:
+    from asyncio import current_task, _get_running_loop
+except ImportError:
+    current_task = None
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    _text_types = (str, unicode)
+except NameError:
+    _text_types = (str,)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logger = logging.getLogger(__name__)
 
 # 全局数据库引擎
 engine = None
 
+# 保护 engine 的初始化，多个线程同时调用 create_engine 时只会创建一次
+_engine_lock = threading.Lock()
+
+# 每个连接最多缓存的预备语句数
+STMT_CACHE_SIZE = 50
+
+# 同一连接上执行多少次的sql才 PREPARE
+PREPARE_THRESHOLD = 5
+
+# 连接 -> 这个连接上的 _Statements，连接被关闭回收时自动清除
+_stmt_cache = weakref.WeakKeyDictionary()
+
+# 可以使用 PREPARE 预备的语句
+_PREPARABLE = frozenset(['select', 'insert', 'update', 'delete', 'values'])
+
+# PREPARE 失败过的sql（如 in ? 传入元组、参数类型无法推断），以后直接执行
+_unpreparable = set()
+
+# 预备语句名的序号，保证同一连接上的名字不会重复
+_stmt_seq = itertools.count()
+
+# numeric 列默认解析为 Decimal，开销较大；不需要精确小数时可以直接解析为 float
+DEC2FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'DEC2FLOAT',
+    lambda value, cursor: float(value) if value is not None else None)
+
+# (表名, 字段, values部分) -> insert 语句
+INSERT_CACHE_SIZE = 512
+_insert_cache = {}
+
+# sql -> 占位符转换后的sql
+XLATE_CACHE_SIZE = 1024
+_xlate_cache = {}
+
+
+# next_id 使用的 (进程随机前缀, 序号)，fork 出的子进程会重新生成
+_id_state = None
+
+# 没有 os.register_at_fork（python2）时记录生成 _id_state 的进程id，由 next_id 检查是否 fork 过
+_id_pid = None
+
+
+def _reset_id_state():
+    global _id_state, _id_pid
+    _id_state = (uuid.uuid4().hex[:26], itertools.count())
+    if not hasattr(os, 'register_at_fork'):
+        _id_pid = os.getpid()
+
+
+_reset_id_state()
+if hasattr(os, 'register_at_fork'):
+    # 由 fork 通知子进程重新生成，next_id 不必每次调用 getpid
+    os.register_at_fork(after_in_child=_reset_id_state)
+
 
 def next_id(t=None):
     """
-    生成一个唯一id 由 当前时间 + 随机数（伪随机数）拼接
+    生成一个唯一id 由 当前时间 + 进程随机前缀 + 自增序号 拼接，共 50 位
+    随机前缀每个进程只生成一次，不必每次都读取系统随机数；
+    以时间开头，id 按生成时间有序，插入索引时局部性更好
     """
     if t is None:
         t = time.time()
-    return "%015d%s000" % (int(t * 1000), uuid.uuid4().hex)
+    if _id_pid is not None and _id_pid != os.getpid():
+        _reset_id_state()
+    prefix, seq = _id_state
+    return "%015d%s%06x000" % (int(t * 1000), prefix, next(seq) & 0xffffff)
 
 
 def _profiling(start, sql=''):
@@ -27,36 +132,9 @@ def _profiling(start, sql=''):
     """
     t = time.time() - start
     if t > 0.1:
-        logging.warning("[PROFILING] [DB] %s: %s" % (t, sql))
+        logger.warning("[PROFILING] [DB] %s: %s", t, sql)
     else:
-        logging.info("[PROFILING] [DB] %s: %s" % (t, sql))
-
-
-def DBError(Exception):
-    pass
-
-
-def MultiColumsError(DBError):
-    pass
-
-
-class Dict(dict):
-    """
-    """
-
-    def __init__(self, names=(), values=(), **kw):
-        super(Dict, self).__init__(**kw)
-        for k, v in zip(names, values):
-            self[k] = v
-
-    def __getattr__(self, key):
-        try:
-            return self[key]
-        except KeyError:
-            raise AttributeError(r"'Dict' object has no attribute '%s'" & key)
-
-    def __setattr__(self, key, value):
-        self[key] = value
+        logger.info("[PROFILING] [DB] %s: %s", t, sql)
 
 
 # 数据可以引擎对象
@@ -64,35 +142,119 @@ class _Engine(object):
     """
     数据库引擎对象
     用于保存 db 模块的核心函数：
-    create_engine 创建出来的数据库连接
+    create_engine 创建出来的数据库连接池
+    连接用完后通过 release 归还连接池，而不是关闭，
+    避免每次请求都重新建立 TCP 连接和认证握手
+    max_inactive_connection_lifetime 秒内未被使用的空闲连接会被关闭重建，
+    为 0 或 None 时不检查
+    连接池已满时 connect 最多等待 timeout 秒，等其他线程归还连接，超时抛出 DBError
+    numeric_as_float 为 True 时，只在这个连接池的连接上把 numeric 解析为 float
+    连接均为 autocommit 模式，只有事务中执行了语句时才发送 BEGIN
     """
 
-    def __init__(self, connect):
-        self._connect = connect
+    def __init__(self, pool, maxconn, max_inactive_connection_lifetime=None,
+                 numeric_as_float=False, timeout=30.0):
+        self._pool = pool
+        self._timeout = timeout
+        self._numeric_as_float = numeric_as_float
+        self._slots = threading.Semaphore(maxconn)
+        self._max_inactive = max_inactive_connection_lifetime
+        # 连接 -> 归还时间，连接被关闭回收时自动清除
+        self._released_at = weakref.WeakKeyDictionary()
+
+    def _acquire(self):
+        try:
+            return self._slots.acquire(timeout=self._timeout)
+        except TypeError:
+            # python2 的 Semaphore.acquire 不支持 timeout，轮询等待
+            deadline = time.time() + self._timeout
+            while not self._slots.acquire(False):
+                if time.time() >= deadline:
+                    return False
+                time.sleep(0.01)
+            return True
 
     def connect(self):
-        return self._connect()
+        if not self._acquire():
+            raise DBError('No free connection in the pool after %s seconds.' % self._timeout)
+        try:
+            conn = self._pool.getconn()
+            released_at = self._released_at.pop(conn, None)
+            if self._max_inactive and released_at is not None \
+                    and time.time() - released_at > self._max_inactive:
+                # 空闲太久的连接可能已被服务端断开，关闭后重新获取
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+            if not conn.autocommit:
+                conn.autocommit = True
+            if self._numeric_as_float:
+                psycopg2.extensions.register_type(DEC2FLOAT, conn)
+            return conn
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            close = False
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    # 连接处于 autocommit 模式，putconn 中的 rollback() 不会发送任何语句，
+                    # 未结束或已中止的事务需要在这里显式回滚
+                    cursor = conn.cursor()
+                    cursor.execute('ROLLBACK')
+                    cursor.close()
+            except psycopg2.Error:
+                close = True
+            if self._max_inactive and not close:
+                self._released_at[conn] = time.time()
+            self._pool.putconn(conn, close=close)
+        finally:
+            self._slots.release()
 
 
 def create_engine(user, password, database, host='127.0.0.1', port=5432, db_type="postgres", **kw):
     """
     db模型的核心函数，用于连接数据库，生成全局对象engine，
-    engine对象持有数据库连接
+    engine对象持有数据库连接池
+    连接池参数（与 asyncpg 的 create_pool 对应）：
+        min_size / minconn: 连接池最少保持的连接数，默认 2
+        max_size / maxconn: 连接池最多允许的连接数，默认 20
+        max_inactive_connection_lifetime: 空闲连接的最长存活秒数，默认 300
+        pool_timeout: 连接池已满时等待空闲连接的最长秒数，超时抛出 DBError，默认 30
+    其他参数：
+        numeric_as_float: 为 True 时 numeric 列解析为 float 而不是 Decimal，默认 False
+    engine 已经初始化时直接返回已有的 engine
     """
-    global engine
     if engine is not None:
-        raise DBError('Engine is already initialized.')
+        return engine
+    with _engine_lock:
+        if engine is not None:
+            return engine
+        return _create_engine(user, password, database, host, port, db_type, **kw)
+
+
+def _create_engine(user, password, database, host, port, db_type, **kw):
+    global engine
     params = dict(user=user, password=password,
-                  database=database, host=host, port=port)
+                  database=database, host=host, port=port,
+                  application_name=kw.pop('application_name', 'transwarp'))
     defaults = dict(use_unicode=True, charset='utf8',
                     collation='utf8_general_ci', autocommit=False)
 
     
 
     if db_type == 'postgres':
-        engine = _Engine(lambda: psycopg2.connect(**params))
+        minconn = kw.pop('min_size', kw.pop('minconn', 2))
+        maxconn = kw.pop('max_size', kw.pop('maxconn', 20))
+        max_inactive = kw.pop('max_inactive_connection_lifetime', 300.0)
+        numeric_as_float = kw.pop('numeric_as_float', False)
+        pool_timeout = kw.pop('pool_timeout', 30.0)
+        params.update(kw)
+        pool = ThreadedConnectionPool(minconn, maxconn, **params)
+        engine = _Engine(pool, maxconn, max_inactive, numeric_as_float, pool_timeout)
         # test connection...
-        logging.info('Init postgres engine <%s> ok.' % hex(id(engine)))
+        logger.info('Init postgres engine <%#x> ok.', id(engine))
 
     
     if db_type == 'mysql':
@@ -107,74 +269,164 @@ def create_engine(user, password, database, host='127.0.0.1', port=5432, db_type
         #import mysql.connector
         #engine = _Engine(lambda: mysql.connector.connect(**params))
         # test connection...
-        logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
-    
+        logger.info('Init mysql engine <%#x> ok.', id(engine))
+
+    return engine
 
 
 class _LazyConnection(object):
     """
     惰性连接对象
     仅当需要cursor对象时，才连接数据库，获取连接
+    普通游标在连接上只创建一次，之后重复使用，归还连接时才关闭
     """
 
     def __init__(self):
         self.connection = None
+        self._cursor = None
 
     def cursor(self):
+        """
+        返回这个连接上共用的普通游标，调用者不应关闭
+        """
         if self.connection is None:
             _connection = engine.connect()
-            logging.info('[CONNECTION] [OPEN] connection <%s>...' %
-                         hex(id(_connection)))
+            logger.info('[CONNECTION] [OPEN] connection <%#x>...', id(_connection))
             self.connection = _connection
-        return self.connection.cursor()
+        if self._cursor is None:
+            self._cursor = self.connection.cursor()
+        return self._cursor
+
+    def _execute(self, sql):
+        self.cursor().execute(sql)
 
+    # 连接处于 autocommit 模式，connection.commit() 不会发送任何语句，
+    # 所以事务由这里显式结束；BEGIN 与事务中的第一条语句一起发送，见 _DbCtx.begin
     def commit(self):
-        self.connection.commit()
+        self._execute('COMMIT')
 
     def rollback(self):
-        self.connection.rollback()
+        self._execute('ROLLBACK')
 
     def cleanup(self):
+        if self._cursor is not None:
+            _cursor = self._cursor
+            self._cursor = None
+            _cursor.close()
         if self.connection:
             _connection = self.connection
             self.connection = None
-            logging.info('[CONNECTION] [CLOSE] connection <%s>...' %
-                         hex(id(connection)))
-            _connection.close()
+            logger.info('[CONNECTION] [RELEASE] connection <%#x>...', id(_connection))
+            engine.release(_connection)
 
 # 数据库的上下文对象
 
 
-class _DbCtx(threading.local):
+class _LocalVar(threading.local):
+    """
+    没有 contextvars 模块（python2）时 ContextVar 的替代实现，
+    退化为每个线程一份数据
+    """
+
+    def __init__(self, name, default=None):
+        self.value = default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        token = self.value
+        self.value = value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+
+# _DbCtx 在每个上下文中的状态，不可变，每次修改都 set 一个新的状态
+_DbState = collections.namedtuple(
+    '_DbState', 'connection transactions pipeline dirty readonly owner token')
+
+
+def _owner():
+    """
+    返回当前的线程和 asyncio 任务
+    子任务、子线程会复制创建时的上下文，据此判断状态是否属于自己
+    """
+    # 先检查是否有运行中的事件循环，同步代码中不必调用 current_task 再捕获异常
+    if current_task is not None and _get_running_loop() is not None:
+        return threading.current_thread(), current_task()
+    return threading.current_thread(), None
+
+
+def _state_property(name):
+    """
+    将 _DbCtx 的属性读写转发到当前上下文的状态上
+    """
+    def fget(self):
+        state = self._state.get()
+        if state is None:
+            return None
+        return getattr(state, name)
+
+    def fset(self, value):
+        self._state.set(self._state.get()._replace(**{name: value}))
+    return property(fget, fset)
+
+
+class _DbCtx(object):
     """
     db模块的核心对象, 数据库连接的上下文对象，负责从数据库获取和释放连接
     取得的连接是惰性连接对象，因此只有调用cursor对象时，才会真正获取数据库连接
-    该对象是一个 Thread local对象，因此绑定在此对象上的数据 仅对本线程可见
+    绑定在此对象上的数据保存在 ContextVar 中，仅对当前上下文可见：
+    每个线程、每个 asyncio 任务各自持有自己的连接，协程之间不会互相覆盖
+    在 with connection() 中创建的子任务虽然复制了上下文，
+    但状态记录了创建它的线程和任务，子任务会重新初始化自己的连接
     """
 
+    connection = _state_property('connection')
+    transactions = _state_property('transactions')
+    pipeline = _state_property('pipeline')
+    dirty = _state_property('dirty')
+    readonly = _state_property('readonly')
+
     def __init__(self):
-        self.connection = None
-        self.transactions = 0
+        if ContextVar is not None:
+            self._state = ContextVar('db', default=None)
+        else:
+            self._state = _LocalVar('db', default=None)
+
+    def replace(self, **kw):
+        """
+        一次修改多个属性，只生成一个新的状态
+        """
+        self._state.set(self._state.get()._replace(**kw))
 
     def is_init(self):
         """
         返回一个布尔值， 用于判断 此对象的初始化状态
         """
-        return not self.connection is None
+        state = self._state.get()
+        return state is not None and state.owner == _owner()
 
     def init(self):
         """
         初始化连接的上下文对象， 获得一个惰性连接对象
         """
-        self.connection = _LazyConnection()
-        self.transactions = 0
+        state = _DbState(connection=_LazyConnection(), transactions=0, pipeline=None,
+                         dirty=False, readonly=False, owner=_owner(), token=None)
+        token = self._state.set(state)
+        self._state.set(state._replace(token=token))
 
     def cleanup(self):
         """
-        清理连接对象，关闭连接
+        清理连接对象，将连接归还连接池
         """
-        self.connection.cleanup()
-        self.connection = None
+        state = self._state.get()
+        try:
+            state.connection.cleanup()
+        finally:
+            self._state.reset(state.token)
 
     def cursor(self):
         """
@@ -182,10 +434,63 @@ class _DbCtx(threading.local):
         """
         return self.connection.cursor()
 
+    def begin(self):
+        """
+        事务中执行第一条语句前才需要 BEGIN，没有执行任何语句的事务
+        不需要 BEGIN/COMMIT；readonly 事务使用 BEGIN READ ONLY
+        返回需要与下一条语句一起发送的 BEGIN，不需要时返回 ''；
+        在 pipeline 中时 BEGIN 直接放入 pipeline
+        """
+        if not self.transactions or self.dirty:
+            return ''
+        self.dirty = True
+        begin = 'BEGIN READ ONLY' if self.readonly else 'BEGIN'
+        if self.pipeline is not None:
+            self.pipeline.append(begin.encode('ascii'))
+            return ''
+        return begin
+
+    def execute(self, sql, args):
+        """
+        执行以 ? 为占位符的sql，返回游标
+        事务中第一条语句之前的 BEGIN 与这条语句合并发送，不单独占用一次网络往返
+        """
+        begin = self.begin()
+        self.flush()
+        cursor = self.connection.cursor()
+        try:
+            _execute(cursor, sql, args, begin)
+        except:
+            if begin and cursor.connection.get_transaction_status() == TRANSACTION_STATUS_IDLE:
+                # 语句没有发送出去，BEGIN 也没有，由下一条语句重新发送
+                self.dirty = False
+            raise
+        return cursor
+
+    def flush(self):
+        """
+        将 pipeline 中缓存的语句合并为一条发送，只需一次网络往返
+        """
+        if self.pipeline:
+            statements = self.pipeline
+            self.pipeline = []
+            self.connection.cursor().execute(b';'.join(statements))
+
+    def discard(self):
+        """
+        丢弃 pipeline 中尚未发送的语句
+        事务的 BEGIN 如果也在其中，同样没有发送，由事务中的下一条语句重新发送
+        """
+        if self.pipeline:
+            if self.pipeline[0] in (b'BEGIN', b'BEGIN READ ONLY'):
+                self.replace(pipeline=[], dirty=False)
+            else:
+                self.pipeline = []
 
-#_db_ctx是threadlocal对象，
-# 所以，它持有的数据库连接对于每个线程看到的都是不一样的。
-# 任何一个线程都无法访问到其他线程持有的数据库连接。
+
+#_db_ctx的状态保存在ContextVar中，
+# 所以，它持有的数据库连接对于每个线程、每个协程看到的都是不一样的。
+# 任何一个线程或协程都无法访问到其他线程或协程持有的数据库连接。
 _db_ctx = _DbCtx()
 
 
@@ -207,7 +512,7 @@ class _Connection(object):
     def __exit__(self, exctype, excvalue, traceback):
         global _db_ctx
         if self.should_cleanup:
-            _db_ctx.cleanup
+            _db_ctx.cleanup()
 
 
 def connection():
@@ -235,8 +540,15 @@ class _TransactionCtx(object):
     """
     事务嵌套比Connect嵌套复杂一点，因为事务嵌套需要计数，
     每遇到一层嵌套就+1，离开一层嵌套就-1，最后到0时候提交事务
+    BEGIN 推迟到事务中执行第一条语句（select 或 update）时，与这条语句一起发送，
+    没有执行任何语句的事务既不发送 BEGIN 也不发送 COMMIT
+    readonly 只对最外层事务有效，事务中的所有语句都在只读事务中执行，
+    写入语句会被数据库拒绝
     """
 
+    def __init__(self, readonly=False):
+        self.readonly = readonly
+
     def __enter__(self):
         global _db_ctx
         self.should_close_conn = False
@@ -244,14 +556,23 @@ class _TransactionCtx(object):
             # 打开连接
             _db_ctx.init()
             self.should_close_conn = True
-        _db_ctx.transactions += 1
-        logging.info('begin transaction...' if _db_ctx.transactions ==
-                     1 else "join current transaction...")
+        if _db_ctx.transactions == 0:
+            # pipeline 中事务开始前缓存的语句不属于这个事务，先发送出去
+            _db_ctx.flush()
+        if _db_ctx.transactions == 0:
+            _db_ctx.replace(transactions=1, readonly=self.readonly)
+        else:
+            _db_ctx.transactions += 1
+        logger.info('begin transaction...' if _db_ctx.transactions ==
+                    1 else "join current transaction...")
         return self
 
     def __exit__(self, exctype, excvalue, traceback):
         global _db_ctx
-        _db_ctx.transactions -= 1
+        if _db_ctx.transactions == 1:
+            _db_ctx.replace(transactions=0, readonly=False)
+        else:
+            _db_ctx.transactions -= 1
         try:
             if _db_ctx.transactions == 0:
                 if exctype is None:
@@ -264,23 +585,39 @@ class _TransactionCtx(object):
 
     def commit(self):
         global _db_ctx
-        logging.info("commit transation...")
+        logger.info("commit transation...")
+        try:
+            _db_ctx.flush()
+        except:
+            # pipeline 中缓存的语句执行失败，回滚后将异常交给调用者
+            logger.warning("flush failed. rollback...")
+            self.rollback()
+            raise
         try:
-            _db_ctx.connection.commit()
-            logging.info("commit ok.")
+            if _db_ctx.dirty:
+                _db_ctx.connection.commit()
+            logger.info("commit ok.")
         except:
-            logging.warning("commit failed. try rollback...")
+            logger.warning("commit failed. try rollback...")
             _db_ctx.connection.rollback()
-            logging.warning('roll')
+            logger.warning('roll')
+        finally:
+            _db_ctx.dirty = False
 
     def rollback(self):
         global _db_ctx
-        logging.warning("rollback transaction...")
-        _db_ctx.connection.rollback()
-        logging.info('rollback ok.')
+        logger.warning("rollback transaction...")
+        # 尚未发送的语句直接丢弃
+        _db_ctx.discard()
+        try:
+            if _db_ctx.dirty:
+                _db_ctx.connection.rollback()
+        finally:
+            _db_ctx.dirty = False
+        logger.info('rollback ok.')
 
 
-def transaction():
+def transaction(readonly=False):
     """
     db模块核心函数 用于实现事物功能
     支持：
@@ -293,8 +630,15 @@ def transaction():
             transaction1
             transaction2
             ...
+    只读事务：
+        with db.transaction(readonly=True):
+            db.select("...")
+            db.select("...")
+    >>> with transaction(readonly=True):
+    ...     select_one('select * from "user" where id=?', 200).name
+    u'Wall.E'
     """
-    return _TransactionCtx()
+    return _TransactionCtx(readonly)
 
 
 def with_transaction(func):
@@ -328,38 +672,454 @@ def with_transaction(func):
     return wrapped
 
 
+class _PipelineCtx(object):
+    """
+    pipeline 内的 update 语句不会立即执行，而是先缓存起来，
+    直到离开 pipeline、提交事务或执行 select 时才合并为一条语句发送，
+    k 条语句只需一次网络往返
+    pipeline 支持嵌套，只有最外层离开时才发送
+    """
+
+    def __enter__(self):
+        global _db_ctx
+        self.should_close_conn = False
+        if not _db_ctx.is_init():
+            _db_ctx.init()
+            self.should_close_conn = True
+        self.is_outer = _db_ctx.pipeline is None
+        if self.is_outer:
+            _db_ctx.pipeline = []
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        global _db_ctx
+        try:
+            if self.is_outer:
+                try:
+                    if exctype is None:
+                        _db_ctx.flush()
+                    else:
+                        _db_ctx.discard()
+                finally:
+                    _db_ctx.pipeline = None
+        finally:
+            if self.should_close_conn:
+                _db_ctx.cleanup()
+
+
+def pipeline():
+    """
+    db模块核心函数 用于批量发送update语句
+    注意：pipeline 内的 update 无法得到影响的行数，返回 None
+    pipeline 内抛出异常时，缓存的 update 全部丢弃，不会发送，
+    即使 pipeline 不在事务中也是如此
+        with db.transaction():
+            with db.pipeline():
+                db.update("...")
+                db.update("...")
+                db.update("...")
+    >>> u = dict(id=400, name='Pipe', email='pipe@test.org', passwd='pipe', last_modified=time.time())
+    >>> insert('user', **u)
+    1
+    >>> with pipeline():
+    ...     update('update "user" set passwd=? where id=?', 'PIPE-1', 400)
+    ...     update('update "user" set name=? where id=?', 'PIPE-2', 400)
+    >>> select_one('select * from "user" where id=?', 400).passwd
+    u'PIPE-1'
+    >>> try:
+    ...     with transaction():
+    ...         try:
+    ...             with pipeline():
+    ...                 update('update "user" set name=? where id=?', 'Lost', 400)
+    ...                 raise ValueError('discard')
+    ...         except ValueError:
+    ...             pass
+    ...         update('update "user" set name=? where id=?', 'Rolled-back', 400)
+    ...         raise ValueError('rollback')
+    ... except ValueError:
+    ...     pass
+    1
+    >>> select_one('select * from "user" where id=?', 400).name
+    u'PIPE-2'
+    """
+    return _PipelineCtx()
+
+
+def _insert_sql(table, cols, values):
+    """
+    生成 insert 语句，表名和字段名由 psycopg2 按标识符规则转义
+    结果按 (表名, 字段, values部分) 缓存，同样的插入总是得到同样的sql，
+    预备语句缓存也就能命中；缓存满时整体清空
+    """
+    key = (table, cols, values)
+    try:
+        return _insert_cache[key]
+    except KeyError:
+        sql = SQL('insert into {} ({}) values {}').format(
+            Identifier(table), SQL(',').join([Identifier(col) for col in cols]),
+            SQL(values)).as_string(_db_ctx.connection.cursor().connection)
+        if len(_insert_cache) >= INSERT_CACHE_SIZE:
+            _insert_cache.clear()
+        _insert_cache[key] = sql
+        return sql
+
+
+@with_connection
 def insert(table, **kw):
     """
-    执行insert语句
+    执行insert语句，返回insert的行数
+    多行插入请使用 insert_many
+    """
+    cols, args = zip(*kw.items())
+    sql = _insert_sql(table, cols, '(%s)' % ','.join(['?'] * len(cols)))
+    return _update(sql, *args)
+
+
+@with_transaction
+def insert_many(table, rows, page_size=1000):
+    """
+    批量执行insert语句，返回insert的行数
+    rows 是字段相同的 dict 列表，每 page_size 行合并为一条 insert 语句发送，
+    避免循环调用 insert 时每行一次网络往返，所有行在同一个事务中插入
+    超过约一万行的大批量导入请使用 copy_from
+    >>> L = [dict(id=300 + i, name='Bulk%s' % i, email='bulk%s@test.org' % i, passwd='bulk', last_modified=time.time()) for i in range(3)]
+    >>> insert_many('user', L)
+    3
+    >>> select_int('select count(*) from "user" where passwd=?', 'bulk')
+    3
+    """
+    global _db_ctx
+    if not rows:
+        return 0
+    cols = tuple(rows[0].keys())
+    sql = _insert_sql(table, cols, '%s')
+    logger.info('SQL: %s, ROWS: %s', sql, len(rows))
+    begin = _db_ctx.begin()
+    _db_ctx.flush()
+    cursor = _db_ctx.connection.cursor()
+    if begin:
+        cursor.execute(begin)
+    execute_values(cursor, sql,
+                   [[r[c] for c in cols] for r in rows], page_size=page_size)
+    return len(rows)
+
+
+def _copy_literal(v):
+    """
+    将一个值转换为 postgres 的文本字面量：
+    字符串、数值、日期时间、UUID 直接格式化，二进制转为 bytea 的十六进制格式，
+    dict 转为 json，list/tuple 转为数组；其他类型抛出 TypeError
+    """
+    if isinstance(v, _text_types):
+        return v
+    if isinstance(v, (numbers.Real, decimal.Decimal, datetime.date,
+                      datetime.time, uuid.UUID)):
+        return '%s' % v
+    if isinstance(v, (bytes, bytearray, memoryview)):
+        return '\\x' + binascii.hexlify(bytes(v)).decode('ascii')
+    if isinstance(v, dict):
+        return json.dumps(v)
+    if isinstance(v, (list, tuple)):
+        items = []
+        for x in v:
+            if x is None:
+                items.append('NULL')
+            elif isinstance(x, (list, tuple)):
+                items.append(_copy_literal(x))
+            else:
+                items.append('"%s"' % _copy_literal(x).replace('\\', '\\\\').replace('"', '\\"'))
+        return '{%s}' % ','.join(items)
+    raise TypeError('copy_from does not support values of type %s' % type(v).__name__)
+
+
+def _copy_value(v):
+    """
+    转换为 COPY 文本格式的一个字段：None 写为 \\N，转义反斜杠、制表符和换行
+    """
+    if v is None:
+        return '\\N'
+    return _copy_literal(v).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+@with_connection
+def copy_from(table, rows, columns=None):
+    """
+    使用 COPY ... FROM STDIN 批量导入，返回导入的行数
+    rows 是字段相同的 dict 列表，columns 默认为第一行的全部字段
+    数据以 COPY 文本格式一次性发送，由数据库直接装载，不经过逐条 insert 的解析和执行，
+    超过约一万行时比 insert_many 快得多；行数较少时使用 insert_many 即可
+    None 写为 NULL，bytes 写为 bytea，dict 写为 json，list/tuple 写为数组，
+    不支持的类型抛出 TypeError
+    >>> L = [dict(id=500 + i, name='Copy%s' % i, email='', passwd='copy', last_modified=time.time()) for i in range(3)]
+    >>> copy_from('user', L)
+    3
+    >>> select_int('select count(*) from "user" where passwd=? and email=?', 'copy', '')
+    3
+    """
+    global _db_ctx
+    if not rows:
+        return 0
+    if columns is None:
+        columns = list(rows[0].keys())
+    buf = StringIO()
+    for r in rows:
+        buf.write('\t'.join([_copy_value(r[c]) for c in columns]))
+        buf.write('\n')
+    buf.seek(0)
+    sql = SQL('copy {} ({}) from stdin').format(
+        Identifier(table), SQL(',').join([Identifier(col) for col in columns]))
+    logger.info('SQL: %s, ROWS: %s', sql, len(rows))
+    begin = _db_ctx.begin()
+    _db_ctx.flush()
+    cursor = _db_ctx.connection.cursor()
+    if begin:
+        cursor.execute(begin)
+    cursor.copy_expert(sql, buf)
+    return len(rows)
+
+
+def _xlate(sql):
+    """
+    将 ? 占位符转换为 psycopg2 的 %s，结果按sql缓存，
+    同一条sql只需转换一次，缓存满时整体清空
+    """
+    try:
+        return _xlate_cache[sql]
+    except KeyError:
+        if len(_xlate_cache) >= XLATE_CACHE_SIZE:
+            _xlate_cache.clear()
+        r = _xlate_cache[sql] = sql.replace('?', '%s')
+        return r
+
+
+class _Statements(object):
+    """
+    一个连接上的预备语句
+    names: sql -> 预备语句名，按最近使用的顺序排列
+    uses: 尚未 PREPARE 的sql -> 已经执行的次数
+    stale: 服务端可能残留不在 names 中的预备语句，下次 PREPARE 时先 DEALLOCATE ALL
+    """
+
+    def __init__(self):
+        self.names = collections.OrderedDict()
+        self.uses = {}
+        self.stale = False
+
+
+def _execute_sql(name, args):
+    """
+    EXECUTE 一条预备语句的sql和参数
+    """
+    if args:
+        return 'EXECUTE %s (%s)' % (name, ','.join(['%s'] * len(args))), args
+    return 'EXECUTE %s' % name, None
+
+
+def _with_begin(begin, sql):
+    """
+    将 BEGIN 放在sql之前，作为一条语句发送
     """
-    cols, args = zip(*kw.iteritems())
-    sql = "insert into '%s' (%s) values (%s)" % (table, ','.join(
-        ["'%s'" % col for col in cols]), ','.join(["?" for i in range(len(cols))]))
+    if begin:
+        return '%s;%s' % (begin, sql)
+    return sql
+
+
+def _execute(cursor, sql, args, begin=''):
+    """
+    执行以 ? 为占位符的sql，begin 不为空时与sql一起发送
+    同一连接上执行满 PREPARE_THRESHOLD 次的 select/insert/update/delete 语句
+    会被 PREPARE 为预备语句并按连接缓存，之后直接 EXECUTE，服务端不必再次解析和生成执行计划；
+    只执行一两次的sql直接执行，不必多花一次 PREPARE
+    每个连接最多缓存 STMT_CACHE_SIZE 条，超出时释放最久未使用的一条
+    注意预备语句的参数类型由服务端根据sql推断，直接执行时参数则作为字面量传入：
+    例如 where id=? 传入 1.5，直接执行时按 numeric 比较，预备后会先转换为整数 2，
+    因此参数的类型应与字段一致，否则sql执行满 PREPARE_THRESHOLD 次前后的结果可能不同
+    """
+    if sql.lstrip()[:6].lower() not in _PREPARABLE or sql in _unpreparable:
+        cursor.execute(_with_begin(begin, _xlate(sql)), args)
+        return
+    conn = cursor.connection
+    stmts = _stmt_cache.get(conn)
+    if stmts is None:
+        stmts = _stmt_cache[conn] = _Statements()
+    name = stmts.names.pop(sql, None)
+    if name is not None:
+        stmts.names[sql] = name
+        _execute_prepared(cursor, stmts, sql, name, args, begin)
+        return
+    uses = stmts.uses.pop(sql, 0) + 1
+    if uses < PREPARE_THRESHOLD or \
+            conn.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+        if len(stmts.uses) >= XLATE_CACHE_SIZE:
+            stmts.uses.clear()
+        stmts.uses[sql] = uses
+        cursor.execute(_with_begin(begin, _xlate(sql)), args)
+        return
+    _prepare_execute(cursor, stmts, sql, args, begin)
+
+
+def _execute_prepared(cursor, stmts, sql, name, args, begin):
+    """
+    EXECUTE 已经缓存的预备语句
+    表结构变化导致缓存的计划失效时，清空这个连接的预备语句：
+    不在事务中时释放服务端的全部预备语句后直接重新执行；
+    在事务中时事务已经中止，只能由调用者重试，服务端的预备语句留到下次 PREPARE 时释放
+    """
+    query, params = _execute_sql(name, args)
+    try:
+        cursor.execute(_with_begin(begin, query), params)
+    except psycopg2.Error as e:
+        # 0A000: cached plan must not change result type
+        if e.pgcode != '0A000':
+            raise
+        stmts.names.clear()
+        if cursor.connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            stmts.stale = True
+            raise
+        stmts.stale = False
+        cursor.execute('DEALLOCATE ALL;' + _xlate(sql), args)
+
+
+def _prepare_execute(cursor, stmts, sql, args, begin):
+    """
+    PREPARE 并 EXECUTE 一条sql，需要释放的旧预备语句也一起 DEALLOCATE，只需一次网络往返
+    为了在失败时分辨是 PREPARE 还是 EXECUTE 出错，
+    事务中的 PREPARE 放在保存点里，事务外的 PREPARE 放在单独的事务里，都在 EXECUTE 之前结束；
+    PREPARE 失败（如 in ? 传入元组、参数类型无法推断）时这条sql以后直接执行
+    """
+    conn = cursor.connection
+    name = 'p_%d' % next(_stmt_seq)
+    block = ['PREPARE %s AS %s' % (name, numbered(sql))]
+    evicted = None
+    if stmts.stale:
+        # DEALLOCATE ALL 必须在 PREPARE 之前
+        block.insert(0, 'DEALLOCATE ALL')
+    elif len(stmts.names) >= STMT_CACHE_SIZE:
+        evicted = next(iter(stmts.names))
+        block.append('DEALLOCATE %s' % stmts.names[evicted])
+    in_transaction = bool(begin) or conn.get_transaction_status() != TRANSACTION_STATUS_IDLE
+    if in_transaction:
+        block = ['SAVEPOINT _prepare'] + block + ['RELEASE SAVEPOINT _prepare']
+        if begin:
+            block.insert(0, begin)
+    else:
+        block = ['BEGIN'] + block + ['COMMIT']
+    query, params = _execute_sql(name, args)
+    head = ';'.join(block) + ';'
+    if params:
+        head = head.replace('%', '%%')
+    try:
+        cursor.execute(head + query, params)
+    except psycopg2.Error:
+        if not _rollback_prepare(cursor, in_transaction):
+            # PREPARE 已经成功，出错的是 EXECUTE
+            _remember(stmts, sql, name, evicted)
+            raise
+        if evicted is not None:
+            # 不确定旧的预备语句是否已经释放，下次 PREPARE 时全部释放
+            stmts.names.clear()
+            stmts.stale = True
+        if len(_unpreparable) >= XLATE_CACHE_SIZE:
+            _unpreparable.clear()
+        _unpreparable.add(sql)
+        cursor.execute(_xlate(sql), args)
+        return
+    _remember(stmts, sql, name, evicted)
+
+
+def _rollback_prepare(cursor, in_transaction):
+    """
+    _prepare_execute 出错后回滚 PREPARE 所在的保存点或事务，
+    返回 True 表示出错的是 PREPARE 所在的部分，连接已恢复到执行之前的状态
+    """
+    if in_transaction:
+        try:
+            cursor.execute('ROLLBACK TO SAVEPOINT _prepare;RELEASE SAVEPOINT _prepare')
+            return True
+        except psycopg2.Error:
+            return False
+    if cursor.connection.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+        cursor.execute('ROLLBACK')
+        return True
+    return False
+
+
+def _remember(stmts, sql, name, evicted):
+    """
+    记录 PREPARE 成功的语句
+    """
+    if evicted is not None:
+        del stmts.names[evicted]
+    stmts.stale = False
+    stmts.names[sql] = name
 
 
 @with_connection
 def _select(sql, first, *args):
     """
     执行SQL，返回一个结果 或者多个结果组成的列表
+    这里只使用普通（无名）游标，一次往返取回全部结果；
+    服务端游标需要额外的 DECLARE/FETCH/CLOSE 往返，只在 select_stream 中使用
     """
     global _db_ctx
-    cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    logger.info('SQL: %s, ARGS: %s', sql, args)
+    cursor = _db_ctx.execute(sql, args)
+    if cursor.description:
+        names = [x[0] for x in cursor.description]
+    if first:
+        values = cursor.fetchone()
+        if not values:
+            return None
+        return Dict(names, values)
+    rows = cursor.fetchall()
+    if not rows:
+        return []
+    make = Dict
+    return [make(names, x) for x in rows]
+
+def select_stream(sql, *args, **kw):
+    """
+    执行sql 以生成器形式逐行返回结果，用于结果集很大的查询
+    使用服务端游标，每次网络往返取回 itersize 行（默认 2000），
+    客户端内存占用与结果行数无关
+    普通的小查询请使用 select，只有大查询才值得使用服务端游标
+    生成器从连接池单独取一个连接，在自己的事务中读取，迭代结束时归还；
+    因此迭代过程中可以自由使用事务，但看不到当前事务中尚未提交的修改
+    注意迭代期间同时占用两个连接：在 with connection()/transaction() 中，
+    或者迭代时又执行了其他查询，连接池需要留出第二个连接，否则等待 pool_timeout 后抛出 DBError
+    >>> L = list(select_stream('select * from "user" where passwd=? order by id', 'back-to-earth', itersize=1))
+    >>> [u.name for u in L]
+    [u'Wall.E', u'Eva']
+    """
+    itersize = kw.pop('itersize', 2000)
+    if kw:
+        raise TypeError('select_stream() got an unexpected keyword argument %r' % next(iter(kw)))
+    sql = _xlate(sql)
+    logger.info('SQL: %s, ARGS: %s', sql, args)
+    if _db_ctx.is_init():
+        # pipeline 中缓存的语句先发送，保证执行顺序
+        _db_ctx.flush()
+    conn = engine.connect()
     try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
-        if cursor.description:
-            names = [x[0] for x in cursor.description]
-        if first:
-            values = cursor.fetchone()
-            if not values:
-                return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchone()]
-    finally:
-        if cursor:
+        # 服务端游标只能在事务中使用
+        tx = conn.cursor()
+        tx.execute('BEGIN')
+        cursor = conn.cursor(name='c_' + uuid.uuid4().hex)
+        try:
+            cursor.itersize = itersize
+            cursor.execute(sql, args)
+            names = None
+            for row in cursor:
+                if names is None:
+                    names = [x[0] for x in cursor.description]
+                yield Dict(names, row)
+        finally:
             cursor.close()
+            tx.execute('COMMIT')
+            tx.close()
+    finally:
+        engine.release(conn)
 
 def select_one(sql, *args):
     """
@@ -387,6 +1147,7 @@ def select_int(sql, *args):
     """
     执行一个sql 返回一个数值，
     注意仅一个数值，如果返回多个数值将触发异常
+    如果没有结果 返回None
     >>> u1 = dict(id=96900, name='Ada', email='ada@test.org', passwd='A-12345', last_modified=time.time())
     >>> u2 = dict(id=96901, name='Adam', email='adam@test.org', passwd='A-12345', last_modified=time.time())
     >>> insert('user', **u1)
@@ -407,13 +1168,17 @@ def select_int(sql, *args):
     MultiColumnsError: Expect only one column.
     """
     d = _select(sql, True, *args)
+    if d is None:
+        return None
     if len(d) != 1:
         raise MultiColumsError('Expect only one colum.')
-    return d.values()[0]
+    return list(d.values())[0]
 
 def select(sql, *args):
     """
     执行sql 以列表形式返回结果
+    结果一次全部取回，适合结果集不大的查询；
+    结果很大的查询请使用 select_stream
     >>> u1 = dict(id=200, name='Wall.E', email='wall.e@test.org', passwd='back-to-earth', last_modified=time.time())
     >>> u2 = dict(id=201, name='Eva', email='eva@test.org', passwd='back-to-earth', last_modified=time.time())
     >>> insert('user', **u1)
@@ -435,27 +1200,78 @@ def select(sql, *args):
     return _select(sql, False, *args)
 
 
+def _column(values):
+    """
+    安装了 numpy 且整列都是数值时返回 numpy 数组，否则返回列表
+    """
+    if numpy is not None and values and all(
+            isinstance(v, numbers.Real) and not isinstance(v, bool) for v in values):
+        return numpy.asarray(values)
+    return list(values)
+
+
+@with_connection
+def fetch_columns(sql, *args):
+    """
+    执行sql 按列返回结果：{列名: 该列所有值}
+    每列一个列表，不必为每一行创建一个 Dict，占用的内存少得多；
+    安装了 numpy 时数值列为 numpy 数组，便于对单列做向量化计算
+    注意 numeric 列和 sum() 等结果默认解析为 Decimal，不会转换为 numpy 数组，
+    需要时请在 create_engine 中指定 numeric_as_float=True
+    >>> L = [dict(id=600 + i, name='Col%s' % i, email='col%s@test.org' % i, passwd='col', last_modified=time.time()) for i in range(2)]
+    >>> insert_many('user', L)
+    2
+    >>> c = fetch_columns('select id, name from "user" where passwd=? order by id', 'col')
+    >>> list(c.id)
+    [600, 601]
+    >>> c.name
+    [u'Col0', u'Col1']
+    """
+    global _db_ctx
+    logger.info('SQL: %s, ARGS: %s', sql, args)
+    cursor = _db_ctx.execute(sql, args)
+    names = [x[0] for x in cursor.description]
+    rows = cursor.fetchall()
+    if not rows:
+        return Dict(names, [[] for name in names])
+    return Dict(names, [_column(c) for c in zip(*rows)])
+
+
+@with_connection
+def select_by_ids(table, key, ids, cols='*'):
+    """
+    按主键批量查询，返回 {key: Dict} 字典，查不到的 id 不在结果中
+    所有 id 作为一个数组参数通过 key = any(?) 一次查询取回，
+    需要按多个 id 查询时应使用本函数，而不是循环调用 select_one
+    表名和 key 按标识符转义，cols 原样拼入sql，其中必须包含 key 列
+    >>> d = select_by_ids('user', 'id', [200, 201, 900900900])
+    >>> sorted(d.keys())
+    [200, 201]
+    >>> d[201].name
+    u'Eva'
+    """
+    ids = list(ids)
+    if not ids:
+        return {}
+    sql = SQL('select {} from {} where {} = any(?)').format(
+        SQL(cols), Identifier(table), Identifier(key)).as_string(
+        _db_ctx.connection.cursor().connection)
+    return dict((d[key], d) for d in _select(sql, False, ids))
+
+
 @with_connection
 def _update(sql, *args):
     """
     执行update语句，返回update的行数
     """
     global _db_ctx
-    cursor = None
-    sql = sql.replace('?', "%s")
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
-    try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
-        r = cursor.rowcount
-        if _db_ctx.transactions == 0:
-            # 非事务
-            logging.info('auto commit')
-            _db_ctx.connection.commit()
-        return r
-    finally:
-        if cursor:
-            cursor.close()
+    logger.info('SQL: %s, ARGS: %s', sql, args)
+    if _db_ctx.pipeline is not None:
+        # 在 pipeline 中，仅缓存语句，稍后统一发送
+        _db_ctx.begin()
+        _db_ctx.pipeline.append(_db_ctx.connection.cursor().mogrify(_xlate(sql), args))
+        return None
+    return _db_ctx.execute(sql, args).rowcount
 
 def update(sql, *args):
     """
@@ -0,0 +1,40 @@
+# coding=utf-8
+"""
+db 和 adb 模块共用的部分，不依赖任何数据库驱动
+"""
+
+
+class DBError(Exception):
+    pass
+
+
+class MultiColumsError(DBError):
+    pass
+
+
+class Dict(dict):
+    """
+    支持以属性方式访问的 dict，select 返回的每一行都是一个 Dict
+    names 和 values 直接交给 dict 构造，由 C 实现完成列名与值的组合
+    """
+
+    def __init__(self, names=(), values=(), **kw):
+        super(Dict, self).__init__(zip(names, values), **kw)
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+
+def numbered(sql):
+    """
+    将 ? 占位符转换为 $1, $2 ...，用于 db 模块的 PREPARE 和 adb 模块的 asyncpg
+    不带参数执行时 %% 不会被转义，这里手工还原
+    """
+    parts = sql.replace('%%', '%').split('?')
+    return parts[0] + ''.join(['$%d%s' % (i, part) for i, part in enumerate(parts[1:], 1)])